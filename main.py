@@ -18,7 +18,7 @@ import logging
 import os
 import sys
 from os.path import expanduser
-from metadata import copy_subdir_paths, generate_metadata, get_annotations_source, get_annotations_source_async, move_subdir_paths, set_broken_symlink
+from metadata import copy_subdir_paths, export_genome_statistics, generate_metadata, get_annotations_source_async, get_annotations_sources, group_metadata_by_accession, move_subdir_paths, set_broken_symlink
 from metadata import MetadataParams
 
 script_path = os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir))
@@ -31,6 +31,14 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Script to update directory path for Rapid Release')
     parser.add_argument('-v', '--verbose', help='Verbose output', action='store_true')
@@ -54,31 +62,57 @@ if __name__ == "__main__":
                         default=['geneset', 'genome', 'rnaseq', 'variation' , 'statistics'],
                         help='datatype subdir for ftp dumps'
                         )
+    parser.add_argument('-p', '--processes', type=positive_int,
+                        help='Number of worker processes writing statistics files')
     
 
     arguments = parser.parse_args(sys.argv[1:])
     logger.setLevel(logging.INFO)
     processed_any_species = False
+    statistics_exports = {}
     if not os.path.exists(os.path.join(arguments.ftp_path, 'species' )) or not os.path.exists(os.path.join(arguments.ftp_path, 'timestamped/species' )):
         logger.error(f"No species or timestamped/species dir found in provided ftp_path: {arguments.ftp_path}")
         sys.exit(1)
         
     logger.info("Preparing Directory Path For RR Ftp Dumps With Subdir Annotation Source")
     logger.info(f"Fetching ensembl metadata with provided params: {arguments}")
-    for species_info in generate_metadata(arguments):
+    species_groups = group_metadata_by_accession(generate_metadata(arguments))
+    for (species_name, accession_name), species_releases in species_groups.items():
         
-        logger.info(f"Processing Species {species_info['name']}")
-        logger.info(f"Fetch annotation source from DB  {species_info['dbname']}")
+        release_names = ", ".join(f"{species_info['ensembl_version']}/{species_info['ensembl_genomes_version']}" for species_info in species_releases)
+        logger.info(f"Processing Species {species_name}/{accession_name} for releases {release_names}")
         processed_any_species = True
         try: 
-            core_metadata = get_annotations_source(species_info['dbname'], arguments.coredb_url)
-            #if 'species.annotation_source' not in core_metadata.keys() or core_metadata['species.annotation_source'] == '' :
-            if core_metadata.get('species.annotation_source', '')  ==  '':
-                core_metadata['species.annotation_source'] = 'ensembl' 
+            # annotation source lives in the core db, releases selected without a core db fall back to their own dbs
+            releases_with_core = {(species_info['ensembl_version'], species_info['ensembl_genomes_version']) 
+                                  for species_info in species_releases if species_info['type'] == 'core'}
+            lookup_releases = [species_info for species_info in species_releases 
+                               if species_info['type'] == 'core' or (species_info['ensembl_version'], species_info['ensembl_genomes_version']) not in releases_with_core]
+            logger.info(f"Fetch annotation source from DBs {[species_info['dbname'] for species_info in lookup_releases]}")
+            core_metadata_by_db = get_annotations_sources([species_info['dbname'] for species_info in lookup_releases], arguments.coredb_url)
+            for core_metadata in core_metadata_by_db.values():
+                #if 'species.annotation_source' not in core_metadata.keys() or core_metadata['species.annotation_source'] == '' :
+                if core_metadata.get('species.annotation_source', '')  ==  '':
+                    core_metadata['species.annotation_source'] = 'ensembl' 
+            
+            resolved_releases = [species_info for species_info in lookup_releases if species_info['dbname'] in core_metadata_by_db]
+            resolved_versions = {(species_info['ensembl_version'], species_info['ensembl_genomes_version']) for species_info in resolved_releases}
+            for species_info in species_releases:
+                if (species_info['ensembl_version'], species_info['ensembl_genomes_version']) not in resolved_versions:
+                    logger.error(f"Failed to process species {species_info['name']} release {species_info['ensembl_version']}/{species_info['ensembl_genomes_version']} db {species_info['dbname']}, error: unable to read meta from the dbs of this release on {arguments.coredb_url} ")
+            species_releases = [species_info for species_info in species_releases 
+                                if (species_info['ensembl_version'], species_info['ensembl_genomes_version']) in resolved_versions]
+            if not species_releases:
+                continue
+            
+            # directories are shared by all releases of an accession, the core db of the latest release decides the annotation source
+            source_releases = [species_info for species_info in resolved_releases if species_info['type'] == 'core'] or resolved_releases
+            latest_release = max(source_releases, key=lambda species_info: (species_info['ensembl_version'], species_info['ensembl_genomes_version']))
+            core_metadata = core_metadata_by_db[latest_release['dbname']]
+            annotation_sources = {core_metadata_by_db[species_info['dbname']]['species.annotation_source'].lower() for species_info in source_releases}
+            if len(annotation_sources) > 1:
+                logger.warning(f"Annotation sources {annotation_sources} differ across releases for {species_name}/{accession_name}, using {core_metadata['species.annotation_source']} from {latest_release['dbname']}")
                     
-
-            species_name = "_".join(species_info['display_name'].split(' ')[0:2]) #Homo sapiens (Human) - GCA_018503265.1 
-            accession_name = species_info['assembly_accession'] #GCA_009914755.4
             genebuild_inital = core_metadata.get('genebuild.initial_release_date').replace('-','_') if core_metadata.get('genebuild.initial_release_date', None) else ''
             genebuild_update = core_metadata.get('genebuild.last_geneset_update').replace('-','_') if core_metadata.get('genebuild.initial_release_date', None) else ''
             
@@ -105,15 +139,39 @@ if __name__ == "__main__":
                 
 
                     
-                set_broken_symlink(target_path, data_type, core_metadata['species.annotation_source'], script_path)
-                species_info[data_type] = subdir_paths
+                for species_info in species_releases:
+                    species_info[data_type] = subdir_paths
                 #species_info[data_type] = [ i for i in [ os.path.join(base_path, genebuild_update) , 
                 #                                                               os.path.join(base_path, genebuild_inital)] if os.path.exists(i) ]
 
-            
-            logger.info(f"Sub directory changed for {species_info['name']} with details  {species_info}")
+            # one walk of the annotation source tree fixes the broken symlinks of every data type
+            if os.path.exists(target_path):
+                set_broken_symlink(target_path, arguments.data_type, core_metadata['species.annotation_source'], script_path)
+            else:
+                logger.info(f"No annotation source dir {target_path}, nothing moved to fix symlinks for")
+
+            if 'statistics' in arguments.data_type:
+                statistics_path = os.path.join(arguments.ftp_path, f"species/{species_name}/{accession_name}/{core_metadata['species.annotation_source'].lower()}/statistics")
+                statistics_exports[(species_name, accession_name)] = (statistics_path, species_releases)
+
+            for species_info in species_releases:
+                logger.info(f"Sub directory changed for {species_info['name']} release {species_info['ensembl_version']}/{species_info['ensembl_genomes_version']} with details  {species_info}")
+        except Exception as e:
+            for species_info in species_releases:
+                logger.error(f"Failed to process species {species_info['name']} release {species_info['ensembl_version']}/{species_info['ensembl_genomes_version']}, error: {str(e)} ")
+    
+    if 'statistics' in arguments.data_type:
+        for species_name, accession_name in species_groups:
+            if (species_name, accession_name) not in statistics_exports:
+                logger.info(f"Skipping genome statistics for {species_name}/{accession_name}, directory step failed")
+    
+    if statistics_exports:
+        logger.info(f"Exporting genome statistics for {len(statistics_exports)} of {len(species_groups)} accessions")
+        try:
+            statistics_written = export_genome_statistics(arguments, statistics_exports, processes=arguments.processes)
+            logger.info(f"Genome statistics written for {statistics_written} accessions")
         except Exception as e:
-            logger.error(f"Failed to process species {species_info['name']}, error: {str(e)} ")
+            logger.error(f"Failed to export genome statistics, error: {str(e)} ")
     
     if not processed_any_species:
         logger.error(f"No species found for provided {arguments} , check ens_version & rr_version ")
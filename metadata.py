@@ -1,5 +1,7 @@
+import json
 import os
 import shutil 
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Optional
 from yarl import URL
 from uuid import UUID
@@ -7,9 +9,10 @@ from pydantic import BaseModel, ValidationError, validator
 from sqlalchemy.orm.session import Session
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import  sessionmaker
-from sqlalchemy import select
+from sqlalchemy import column, literal, select, table, union_all
 from ensembl.database.dbconnection import DBConnection
 from metadata_model import Genome, GenomeDatabase, Organism, DataRelease, DataReleaseDatabase, Division, Assembly
+from metadata_model import GenomeAlignment, GenomeAnnotation, GenomeFeature, GenomeVariation
 from ensembl.core.models import Meta
 import logging 
 
@@ -97,6 +100,45 @@ def get_annotations_source(dbname: str, coredb_url: str, meta_keys=['species.ann
         core_query = select(Meta.meta_key, Meta.meta_value).filter(Meta.meta_key.in_(meta_keys))
         result =  dict(session.execute(core_query).all())
         return result
+
+
+def get_annotations_sources(dbnames: List[str], coredb_url: str, meta_keys=['species.annotation_source',
+                                            'genebuild.last_geneset_update',
+                                            'genebuild.initial_release_date']):
+    """Fetch Meta key annotation_source information for several core dbs on the same host in one query
+
+    Args:
+        dbnames (List[str]): core database names hosted on coredb_url
+        coredb_url (str): Mysql url for species core database
+
+    Returns:
+        dict: meta key/value pairs keyed by dbname, dbnames that could not be read are left out
+    """
+    dbnames = list(dict.fromkeys(dbnames))
+    try:
+        core_url_conn_string = os.path.join(coredb_url, dbnames[0])
+        db_connection =  get_db_session(core_url_conn_string)
+        with db_connection.session_scope() as session:
+            core_queries = []
+            for dbname in dbnames:
+                meta = table('meta', column('meta_key'), column('meta_value'), schema=dbname)
+                core_queries.append(select(literal(dbname).label('dbname'), meta.c.meta_key, meta.c.meta_value)
+                                    .filter(meta.c.meta_key.in_(meta_keys)))
+            result = {dbname: {} for dbname in dbnames}
+            for dbname, meta_key, meta_value in session.execute(union_all(*core_queries)):
+                result[dbname][meta_key] = meta_value
+            return result
+    except Exception as e:
+        logger.warning(f"Unable to fetch meta keys from {dbnames} in one query, retrying each db : {str(e)}")
+
+    # one unreadable db must not fail the other releases of the accession
+    result = {}
+    for dbname in dbnames:
+        try:
+            result[dbname] = get_annotations_source(dbname, coredb_url, meta_keys)
+        except Exception as e:
+            logger.error(f"Unable to fetch meta keys from {dbname} : {str(e)}")
+    return result
             
                     
 
@@ -115,9 +157,10 @@ def generate_metadata(metadata_params: MetadataParams):
     metadata_url_conn_string = os.path.join(metadata_params.metadata_url, metadata_params.metadata_dbname)   
     db_connection =  get_db_session(metadata_url_conn_string)
     with db_connection.session_scope() as session:
-        meta_query = select(Assembly.assembly_accession.label("assembly_accession"), Assembly.assembly_name,
+        meta_query = select(GenomeDatabase.genome_database_id, Assembly.assembly_accession.label("assembly_accession"), Assembly.assembly_name,
                Organism.name, Organism.scientific_name, Organism.display_name, Organism.species_taxonomy_id, Organism.strain,
-               Genome.genebuild, GenomeDatabase.dbname,GenomeDatabase.type, DataRelease.release_date).select_from(GenomeDatabase) \
+               Genome.genebuild, GenomeDatabase.dbname,GenomeDatabase.type, DataRelease.release_date,
+               DataRelease.ensembl_version, DataRelease.ensembl_genomes_version).select_from(GenomeDatabase) \
          .join(Genome).join(Assembly).join(Organism).join(DataRelease).join(Division) \
         .filter(DataRelease.ensembl_version.in_( metadata_params.release_version) ) \
         .filter(DataRelease.ensembl_genomes_version.in_(metadata_params.rapid_version))
@@ -138,14 +181,139 @@ def generate_metadata(metadata_params: MetadataParams):
             #species_info['annotation_source'] = get_annotations_source(species_info['dbname'], metadata_params.coredb_url)
 
             yield species_info
-        
 
-def set_broken_symlink(dirname, data_type, annotation_source, script_path):
+
+def group_metadata_by_accession(species_infos):
+    """Group metadata rows sharing the same species/<name>/<accession> ftp directory
+
+    Args:
+        species_infos (Iterable[dict]): rows yielded by generate_metadata
+
+    Returns:
+        dict: list of rows (one per release) keyed by (species_name, accession_name)
+    """
+    species_groups = {}
+    for species_info in species_infos:
+        species_name = "_".join(species_info['display_name'].split(' ')[0:2]) #Homo sapiens (Human) - GCA_018503265.1
+        accession_name = species_info['assembly_accession'] #GCA_009914755.4
+        species_groups.setdefault((species_name, accession_name), []).append(species_info)
+    return species_groups
+
+
+GENOME_STATISTICS = {
+    'features': (GenomeFeature, ['type', 'analysis', 'count']),
+    'variations': (GenomeVariation, ['type', 'name', 'count']),
+    'alignments': (GenomeAlignment, ['type', 'name', 'count']),
+    'annotations': (GenomeAnnotation, ['type', 'value']),
+}
+
+
+def fetch_genome_statistics(session: Session, genome_database_ids: List[int]):
+    """Fetch feature, variation, alignment and annotation counts for a batch of genome databases, one query per table
+
+    Args:
+        session (Session): metadata database session
+        genome_database_ids (List[int]): metadata genome_database ids
+
+    Returns:
+        dict: statistics grouped by table keyed by genome_database_id
+    """
+    statistics = {genome_database_id: {name: [] for name in GENOME_STATISTICS} for genome_database_id in genome_database_ids}
+    for name, (model, fields) in GENOME_STATISTICS.items():
+        stats_query = select(model.genome_database_id, *[getattr(model, field) for field in fields]) \
+            .filter(model.genome_database_id.in_(genome_database_ids))
+        for genome_database_id, *values in session.execute(stats_query):
+            statistics[genome_database_id][name].append(dict(zip(fields, values)))
+    return statistics
+
+
+def write_genome_statistics(statistics_path: str, species_name: str, accession_name: str, releases: List[dict]):
+    """Write the statistics of every release of an accession into statistics_path, run in a worker process
+
+    Args:
+        statistics_path (str): statistics dir under the annotation source
+        species_name (str): species ftp dir name
+        accession_name (str): assembly accession
+        releases (List[dict]): per release genome statistics
+
+    Returns:
+        str: path of the written statistics file
+    """
+    os.makedirs(statistics_path, exist_ok=True)
+    statistics_file = os.path.join(statistics_path, f"{accession_name}_statistics.json")
+    tmp_statistics_file = f"{statistics_file}.tmp"
+    with open(tmp_statistics_file, 'w') as stats_fh:
+        json.dump({'species': species_name, 'assembly_accession': accession_name, 'releases': releases}, stats_fh, indent=2)
+    os.replace(tmp_statistics_file, statistics_file)
+    return statistics_file
+
+
+def export_genome_statistics(metadata_params: MetadataParams, statistics_exports: dict, batch_size: int = 500, processes: Optional[int] = None):
+    """Export genome statistics for the selected releases into per accession statistics files
+
+    Args:
+        metadata_params (MetadataParams): metadata database params
+        statistics_exports (dict): (statistics_path, species_releases) keyed by (species_name, accession_name)
+        batch_size (int): number of accessions fetched per batch of statistics queries
+        processes (Optional[int]): number of worker processes writing the files
+
+    Returns:
+        int: number of statistics files written
+    """
+    metadata_url_conn_string = os.path.join(metadata_params.metadata_url, metadata_params.metadata_dbname)
+    db_connection =  get_db_session(metadata_url_conn_string)
+    export_items = list(statistics_exports.items())
+    written = 0
+    with db_connection.session_scope() as session, ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = []
+        for start in range(0, len(export_items), batch_size):
+            batch = export_items[start:start + batch_size]
+            genome_database_ids = list({species_info['genome_database_id'] for _, (_, species_releases) in batch for species_info in species_releases})
+            logger.info(f"Fetching statistics for {len(genome_database_ids)} genome databases")
+            statistics = fetch_genome_statistics(session, genome_database_ids)
+            
+            submitted = []
+            for (species_name, accession_name), (statistics_path, species_releases) in batch:
+                releases = [dict(dbname=species_info['dbname'],
+                                 ensembl_version=species_info['ensembl_version'],
+                                 rapid_version=species_info['ensembl_genomes_version'],
+                                 genebuild=species_info['genebuild'],
+                                 **statistics[species_info['genome_database_id']]) for species_info in species_releases]
+                future = executor.submit(write_genome_statistics, statistics_path, species_name, accession_name, releases)
+                submitted.append((species_name, accession_name, future))
+            
+            # keep a single batch in flight while the next one is queried
+            written += _collect_statistics_files(pending)
+            pending = submitted
+        written += _collect_statistics_files(pending)
+    return written
+
+
+def _collect_statistics_files(pending):
+    written = 0
+    for species_name, accession_name, future in pending:
+        try:
+            logger.info(f"Statistics written for {species_name}/{accession_name} : {future.result()}")
+            written += 1
+        except Exception as e:
+            logger.error(f"Failed to write statistics for {species_name}/{accession_name} : {str(e)}")
+    return written
+
+
+def set_broken_symlink(dirname, data_types, annotation_source, script_path):
+    """Walk dirname once and point broken symlinks of any data type to the annotation source subdir
+
+    Args:
+        dirname (str): annotation source directory to walk
+        data_types (List[str]): data type subdirs moved under the annotation source
+        annotation_source (str): annotation source subdir name
+        script_path (str): directory to return to after each symlink
+    """
     for name in os.listdir(dirname):
         if name not in (os.curdir, os.pardir):
             full = os.path.join(dirname, name)
             if os.path.isdir(full) and not os.path.islink(full):
-                set_broken_symlink(full,data_type, annotation_source, script_path)
+                set_broken_symlink(full, data_types, annotation_source, script_path)
             elif os.path.islink(full):
 
                 broken_symlink = os.readlink(full)
@@ -155,21 +323,23 @@ def set_broken_symlink(dirname, data_type, annotation_source, script_path):
                 if not os.path.exists(broken_symlink):
                     try:
                         logger.info(f"Setting Broken '{broken_symlink}' symlink for {name} ")
-                        join_sym_link = f"{annotation_source}/{data_type}"
-                        logger.info(f"Replacing  {broken_symlink} with {join_sym_link}")
-                        symlink = broken_symlink.replace(data_type, join_sym_link)
-                        symlink = f"../{symlink}"
-                        logger.info(f"Replacing  {broken_symlink} with {symlink}")
-                        logger.info(f"New symlink with annotation source : {symlink}")
-                        if os.path.exists(symlink) :
-                            logger.info(f"Target symlink exists {symlink} ")
-                            logger.info(f"Remove  existing Broken symlink  {full} ")
-                            os.remove(name)
-                            logger.info(f"setting Target symlink exists {symlink} ")
-                            os.symlink(symlink, name )
-                            logger.info(f"New Symlink for {name} valid status : {os.path.isabs(os.readlink(name))} ")
+                        for data_type in [data_type for data_type in data_types if data_type in broken_symlink]:
+                            join_sym_link = f"{annotation_source}/{data_type}"
+                            logger.info(f"Replacing  {broken_symlink} with {join_sym_link}")
+                            symlink = broken_symlink.replace(data_type, join_sym_link)
+                            symlink = f"../{symlink}"
+                            logger.info(f"Replacing  {broken_symlink} with {symlink}")
+                            logger.info(f"New symlink with annotation source : {symlink}")
+                            if os.path.exists(symlink) :
+                                logger.info(f"Target symlink exists {symlink} ")
+                                logger.info(f"Remove  existing Broken symlink  {full} ")
+                                os.remove(name)
+                                logger.info(f"setting Target symlink exists {symlink} ")
+                                os.symlink(symlink, name )
+                                logger.info(f"New Symlink for {name} valid status : {os.path.isabs(os.readlink(name))} ")
+                                break
                         else:
-                            logger.error(f"Target symlink Does not exists {symlink} ")
+                            logger.error(f"Target symlink Does not exists for {broken_symlink} under {annotation_source} ")
                         
                     except Exception as e:
                         logger.info(f"Changing execution directory to {script_path}")